@@ -1,15 +1,98 @@
 #!/usr/bin/env python3
 
 import argparse
+import collections
+import functools
+import hashlib
+import json
 import multiprocessing
 import os
 import os.path
 import platform
+import re
+import shutil
 import subprocess
 import sys
+import threading
 import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from subprocess import PIPE
 
+# All markers indicating test failure, kept as a single compiled alternation so that scanning stays
+# one pass over the output no matter how many markers get added here
+_PANIC_RE = re.compile(r"!!!PANIC!!!|thread '[^']+' panicked at")
+
+# Queried once at module load; constructing a TestRunner should not cost a syscall per test
+_CPU_COUNT = multiprocessing.cpu_count()
+
+_NS_TO_S = 1e-9
+
+
+# Result cache for --cache, keyed by the test executable contents (see _result_cache_key)
+_CACHE_DIR = os.path.expanduser('~/.cache/hermit-test-runner')
+
+
+def _result_cache_key(test_exe: str, test_command, num_cores: int, hypervisor_files=()) -> str:
+    """Hashes the executable contents together with the exact invocation.
+
+    The hypervisor binaries that influence the result (bootloader, uhyve) are hashed by content as
+    well, so rebuilding one of them at the same path invalidates the key. Hashing is negligible
+    compared to booting a VM.
+    """
+    digest = hashlib.sha256()
+    for path in (test_exe, *hypervisor_files):
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+    digest.update(json.dumps([test_command, num_cores]).encode())
+    return digest.hexdigest()
+
+
+def _load_cached_result(cache_key: str, test_runner):
+    """:return: the cached (rc, stdout, stderr, execution_time, timed_out) tuple or None on miss
+
+    Any unreadable, malformed or incomplete entry (e.g. an older schema) counts as a miss and the
+    test is simply re-run.
+    """
+    try:
+        with open(os.path.join(_CACHE_DIR, cache_key + '.json')) as f:
+            entry = json.load(f)
+        result = entry['rc'], entry['stdout'], entry['stderr'], entry['execution_time'], False
+        test_runner.panic_detected = entry['panic_detected']
+    except (OSError, ValueError, KeyError):
+        return None
+    return result
+
+
+def _store_cached_result(cache_key: str, result, panic_detected: bool):
+    rc, stdout, stderr, execution_time, _timed_out = result
+    entry = {'rc': rc, 'stdout': stdout, 'stderr': stderr, 'execution_time': execution_time,
+             'panic_detected': panic_detected}
+    # A cache that cannot be written (unwritable ~/.cache, disk full) must not fail a test that
+    # already completed - warn and carry on without caching
+    try:
+        os.makedirs(_CACHE_DIR, exist_ok=True)
+        # Write via a per-process temp file and rename so parallel batch workers never observe a
+        # half-written entry
+        path = os.path.join(_CACHE_DIR, cache_key + '.json')
+        tmp_path = '{}.tmp{}'.format(path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print("WARNING: could not store cached test result: {}".format(e), file=sys.stderr)
+
+
+@functools.lru_cache(maxsize=None)
+def _validated_bootloader(path: str) -> str:
+    """Checks the bootloader path and returns it as an absolute path.
+
+    The bootloader is invariant across a whole test suite, so the stat is memoized per process -
+    batch workers constructing many QemuTestRunners pay it only once.
+    """
+    assert os.path.isfile(path), "Invalid bootloader path: {}".format(path)
+    return os.path.abspath(path)
+
 
 class TestRunner:
     """ TestRunner class. Provides methods for running the test and validating test success.
@@ -23,7 +106,7 @@ class TestRunner:
                  memory_in_megabyte=512,
                  gdb_enabled=False,
                  verbose=False):
-        online_cpus = multiprocessing.cpu_count()
+        online_cpus = _CPU_COUNT
         if num_cores > online_cpus:
             print("WARNING: You specified num_cores={}, however only {} cpu cores are available."
                   " Setting num_cores to {}".format(num_cores, online_cpus, online_cpus), file=sys.stderr)
@@ -36,6 +119,7 @@ class TestRunner:
         self.test_command = test_command
         self.custom_env = None
         self.timeout: int = timeout_seconds
+        self.panic_detected: bool = False
 
     def validate_test_success(self, rc, stdout, stderr, execution_time) -> bool:
         """
@@ -49,39 +133,88 @@ class TestRunner:
         # ToDo: possibly add test failure due to excessive execution time?
         #       This could be done if a test suddenly regresses compared to usual execution time
         #       Probably need criterion + stable execution environment for this
-        if not validate_stdout(stdout):
+        if self.panic_detected or not validate_stdout(stdout):
             print("Test failed due to Panic. Dumping output (stderr):\n{}\n\n"
                   "Dumping stdout:\n{}\nFinished Dump".format(stderr, stdout), file=sys.stderr)
             return False
         else:
             return True
 
+    def is_hypervisor_failure(self, rc) -> bool:
+        """True if rc indicates the hypervisor itself failed rather than reporting a test outcome.
+
+        Such results depend on the host environment and must not be cached.
+        """
+        return False
+
+    def cache_relevant_files(self):
+        """Files besides the test executable whose contents influence the test result.
+
+        Subclasses return the hypervisor binaries they run so --cache invalidates on a rebuilt
+        bootloader or upgraded uhyve at the same path.
+        """
+        return []
+
     def run_test(self):
         """
         :return: returncode, stdout, stderr, elapsed_time, timed_out: bool
         """
         print("Calling {}".format(type(self).__name__))
+        # Monotonic to be immune against clock adjustments; kept in ns end to end, only the final
+        # prints convert to seconds
+        start_time = time.perf_counter_ns()
+        # 64 KiB pipe buffer; line iteration still yields lines as soon as they arrive, but a chatty
+        # test no longer pays one read syscall per line
+        p = subprocess.Popen(self.test_command, stdout=PIPE, stderr=PIPE, universal_newlines=True,
+                             bufsize=65536, env=self.custom_env)
+        # Only keep the most recent lines so a chatty test cannot accumulate tens of MB on the host.
+        # The panic marker is checked per line, so it is detected even if its line gets evicted.
+        stdout_lines = collections.deque(maxlen=10000)
+        # stderr must be drained while stdout is read: a test writing more than the pipe capacity
+        # to stderr (e.g. uhyve's -v logging) would otherwise block there and never close stdout
+        stderr_chunks = []
+        stderr_reader = threading.Thread(target=lambda: stderr_chunks.append(p.stderr.read()))
+        stderr_reader.start()
+        timer = threading.Timer(self.timeout, p.kill)
+        timer.start()
         try:
-            start_time = time.perf_counter()  # https://docs.python.org/3/library/time.html#time.perf_counter
-            if self.custom_env is None:
-                p = subprocess.run(self.test_command, stdout=PIPE, stderr=PIPE, universal_newlines=True,
-                        timeout=self.timeout)
-            else:
-                p = subprocess.run(self.test_command, stdout=PIPE, stderr=PIPE, universal_newlines=True,
-                                timeout=self.timeout, env=self.custom_env)
-            end_time = time.perf_counter()
-            elapsed_time = end_time - start_time
-        except subprocess.TimeoutExpired as e:
-            elapsed_time = self.timeout * (10 ** 9)
-            return None, e.stdout, e.stderr, elapsed_time, True
-
-        # ToDo: add some timeout
-        return p.returncode, p.stdout, p.stderr, elapsed_time, False
+            for line in p.stdout:
+                if not self.panic_detected and _PANIC_RE.search(line):
+                    self.panic_detected = True
+                    # No point in letting a panicked test run on until its timeout
+                    p.kill()
+                if self.verbose:
+                    print(line, end='')
+                stdout_lines.append(line)
+            p.wait()
+        finally:
+            timed_out = not timer.is_alive()
+            timer.cancel()
+            stderr_reader.join()
+        stderr = "".join(stderr_chunks)
+        end_time = time.perf_counter_ns()
+        elapsed_time = end_time - start_time
+        stdout = "".join(stdout_lines)
+
+        if timed_out:
+            elapsed_time = self.timeout * 1_000_000_000
+            return None, stdout, stderr, elapsed_time, True
+        return p.returncode, stdout, stderr, elapsed_time, False
+
+
+# QEMU arguments shared by every invocation; the per-test values are appended in __init__ so that
+# building a runner does not re-create the invariant part of the command line
+_QEMU_BASE_ARGS = ('qemu-system-x86_64',
+                   '-display', 'none',
+                   '-serial', 'stdio',
+                   '-cpu', 'qemu64,apic,fsgsbase,rdtscp,xsave,xsaveopt,fxsr',
+                   '-device', 'isa-debug-exit,iobase=0xf4,iosize=0x04',
+                   )
 
 
 class QemuTestRunner(TestRunner):
     """
-    Test Runner for QEMU. Requires a path to the bootloader and the test_exe. 
+    Test Runner for QEMU. Requires a path to the bootloader and the test_exe.
     Verbose is not an option, so the '-vv' flag for `hermit_test_runner.py` behaves the same as `-v`.
     """
 
@@ -92,18 +225,13 @@ class QemuTestRunner(TestRunner):
                  num_cores=1,
                  memory_in_megabyte=512,
                  gdb_enabled=False):
-        assert os.path.isfile(test_exe_path), "Invalid path to test executable: {}".format(test_exe_path)
-        assert os.path.isfile(bootloader_path), "Invalid bootloader path: {}".format(bootloader_path)
-        self.bootloader_path = os.path.abspath(bootloader_path)
-        test_command = ['qemu-system-x86_64',
-                        '-display', 'none',
+        # The test executable is validated once in main(); the bootloader check is memoized
+        self.bootloader_path = _validated_bootloader(bootloader_path)
+        test_command = [*_QEMU_BASE_ARGS,
                         '-smp', str(num_cores),
                         '-m', str(memory_in_megabyte) + 'M',
-                        '-serial', 'stdio',
                         '-kernel', bootloader_path,
                         '-initrd', test_exe_path,
-                        '-cpu', 'qemu64,apic,fsgsbase,rdtscp,xsave,xsaveopt,fxsr',
-                        '-device', 'isa-debug-exit,iobase=0xf4,iosize=0x04',
                         ]
         super().__init__(test_command, 
                         timeout_seconds=timeout_seconds, 
@@ -130,6 +258,14 @@ class QemuTestRunner(TestRunner):
             return False
         return super().validate_test_success(rc, stdout, stderr, execution_time)
 
+    def is_hypervisor_failure(self, rc) -> bool:
+        # rc 1 means QEMU itself failed to run, e.g. because it is not installed
+        # (see validate_test_success)
+        return rc == 1
+
+    def cache_relevant_files(self):
+        return [self.bootloader_path]
+
 
 class UhyveTestRunner(TestRunner):
     def __init__(self, 
@@ -172,6 +308,11 @@ class UhyveTestRunner(TestRunner):
         else:
             return super().validate_test_success(rc, stdout, stderr, execution_time)
 
+    def cache_relevant_files(self):
+        # The uhyve binary may be a bare name looked up via PATH
+        uhyve = shutil.which(self.test_command[0])
+        return [uhyve] if uhyve else []
+
 
 # ToDo: Think about how to pass information about how many tests an executable executed back to the runner
 #  Maybe something like `[TEST_INFO]` at the start of a line?
@@ -182,25 +323,19 @@ def validate_stdout(stdout):
     :return: true if stdout does not indicate test failure
     """
     # Todo: support should_panic tests (Implementation on hermit side with custom panic handler)
-    if "!!!PANIC!!!" in stdout:
-        return False
-    return True
+    return _PANIC_RE.search(stdout) is None
+
+
+# Matches a test name with the hex hash cargo appends ("basic_math-135ecb11e5f4c0ec")
+_HASH_RE = re.compile(r'^(.+)-[0-9a-fA-F]+$')
 
 
 def clean_test_name(name: str):
     if name.endswith('.exe'):
-        name = name.replace('.exe', '')
-    # Remove the hash from the name
-    parts = name.split('-')
-    if len(parts) > 1:
-        try:
-            _hex = int(parts[-1], base=16)  # Test if last element is hex hash
-            clean_name = "-".join(parts[:-1])  # Rejoin with '-' as separator in case test has it in filename
-        except ValueError as e:
-            print(e)
-            clean_name = name  # In this case name doesn't contain a hash, so don't modify it any further
-        return clean_name
-    return name
+        name = name[:-len('.exe')]
+    # Strip the hash from the name; a test without hash is returned unmodified
+    match = _HASH_RE.match(name)
+    return match.group(1) if match else name
 
     # Start "main"
 
@@ -220,61 +355,135 @@ parser.add_argument('--gdb', action='store_true', help='Enables gdb on port 1234
                                                        'entrypoint')
 parser.add_argument('--num_cores', type=int, default=1, help="Number of CPU cores the test should run on")
 parser.add_argument('--timeout', type=int, default=300, help="Timeout in seconds for the test process.")
+parser.add_argument('--jobs', type=int, default=None, help="Number of tests to run in parallel. Only useful when "
+                                                           "multiple test executables are passed as runner_args; "
+                                                           "defaults to the CPU count minus two")
+parser.add_argument('--cache', action='store_true', help="Cache test results on disk keyed by the executable "
+                                                         "contents; reruns of an unchanged binary skip the VM boot")
+parser.add_argument('--no-validate', action='store_true', help="Skip the up-front filesystem checks of the test "
+                                                               "executables; useful on CI where the paths are trusted")
+
+
+def run_single_test(test_exe, args) -> bool:
+    """Builds the TestRunner selected by args for test_exe, runs the test and evaluates the result.
+
+    :return: True if the test succeeded (or was skipped), False otherwise
+    """
+    test_name = os.path.basename(test_exe)
+    test_name = clean_test_name(test_name)
+
+    if args.bootloader_path is not None:
+        test_runner = QemuTestRunner(test_exe,
+                        timeout_seconds=args.timeout,
+                        bootloader_path = args.bootloader_path,
+                        gdb_enabled=args.gdb,
+                        num_cores=args.num_cores
+                        )
+    elif platform.system() == 'Windows':
+        print("Error: using uhyve requires kvm. Please use Linux or Mac OS, or use qemu", file=sys.stderr)
+        exit(-1)
+    else:
+        test_runner = UhyveTestRunner(test_exe,
+                        timeout_seconds=args.timeout,
+                        verbose=args.veryverbose,
+                        gdb_enabled=args.gdb,
+                        num_cores=args.num_cores,
+                        uhyve_path=args.uhyve_path)
+
+    if test_name == "hermit":
+        print("Executing the Unittests is currently broken... Skipping Test NOT marking as failed")
+        # print("Note: If you want to execute all tests, consider adding the '--no-fail-fast' flag")
+        print("If you wish to manually execute the Unittests, you can simply run:")
+        print("`{}`".format(' '.join(test_runner.test_command)))
+        return True
+
+    result = None
+    cache_key = None
+    if args.cache and not args.gdb:  # An interactive gdb session is never worth caching
+        cache_key = _result_cache_key(test_exe, test_runner.test_command, args.num_cores,
+                                      test_runner.cache_relevant_files())
+        result = _load_cached_result(cache_key, test_runner)
+        if result is not None:
+            print("Using cached result for {}".format(test_name))
+    if result is None:
+        result = test_runner.run_test()
+        # Timeouts are likely flaky and hypervisor failures depend on the host environment,
+        # so neither is cached
+        if cache_key is not None and not result[4] and not test_runner.is_hypervisor_failure(result[0]):
+            _store_cached_result(cache_key, result, test_runner.panic_detected)
+
+    rc, stdout, stderr, execution_time, timed_out = result
+    if timed_out:
+        print('Test {} did not finish before timeout of {} seconds'.format(test_name, args.timeout))
+        print("Test failed - Dumping Stderr:\n{}\n\nDumping Stdout:\n{}\n".format(stderr, stdout), file=sys.stderr)
+        return False
+    test_ok = test_runner.validate_test_success(rc, stdout, stderr, execution_time)
+    if test_ok :
+        print("Test Ok: {} - runtime: {} seconds".format(test_name, execution_time * _NS_TO_S))
+        if args.verbose or args.veryverbose:
+            print("Test {} stdout: {}".format(test_name, stdout))
+            print("Test {} stderr: {}".format(test_name, stderr))
+        return True
+    else:
+        print("Test failed: {} - runtime: {} seconds".format(test_name, execution_time * _NS_TO_S))
+        print("Test failed - Dumping Stderr:\n{}\n\nDumping Stdout:\n{}\n".format(stderr, stdout), file=sys.stderr)
+        return False
+
 
-args = parser.parse_args()
-print("Arguments: {}".format(args.runner_args))
-
-# The last argument is the executable, all other arguments are ignored for now - ToDo: recheck this
-test_exe = args.runner_args[-1]
-assert isinstance(test_exe, str)
-assert os.path.isfile(test_exe)  # If this fails likely something about runner args changed
-assert args.timeout > 0, "Timeout must be a positive integer" # Todo: add range checking directly into parser.add_argument
-# ToDo: Add additional test based arguments for qemu / uhyve
-
-test_name = os.path.basename(test_exe)
-test_name = clean_test_name(test_name)
-
-if args.bootloader_path is not None:
-    test_runner = QemuTestRunner(test_exe, 
-                    timeout_seconds=args.timeout, 
-                    bootloader_path = args.bootloader_path, 
-                    gdb_enabled=args.gdb, 
-                    num_cores=args.num_cores
-                    )
-elif platform.system() == 'Windows':
-    print("Error: using uhyve requires kvm. Please use Linux or Mac OS, or use qemu", file=sys.stderr)
-    exit(-1)
-else:
-    test_runner = UhyveTestRunner(test_exe, 
-                    timeout_seconds=args.timeout, 
-                    verbose=args.veryverbose, 
-                    gdb_enabled=args.gdb, 
-                    num_cores=args.num_cores,
-                    uhyve_path=args.uhyve_path)
-
-if test_name == "hermit":
-    print("Executing the Unittests is currently broken... Skipping Test NOT marking as failed")
-    # print("Note: If you want to execute all tests, consider adding the '--no-fail-fast' flag")
-    print("If you wish to manually execute the Unittests, you can simply run:")
-    print("`{}`".format(' '.join(test_runner.test_command)))
-    exit(0)
-
-rc, stdout, stderr, execution_time, timed_out = test_runner.run_test()
-if timed_out:
-    print('Test {} did not finish before timeout of {} seconds'.format(test_name, args.timeout))
-    print("Test failed - Dumping Stderr:\n{}\n\nDumping Stdout:\n{}\n".format(stderr, stdout), file=sys.stderr)
-    exit(1)
-test_ok = test_runner.validate_test_success(rc, stdout, stderr, execution_time)
-if test_ok :
-    print("Test Ok: {} - runtime: {} seconds".format(test_name, execution_time))
-    if args.verbose or args.veryverbose:
-        print("Test {} stdout: {}".format(test_name, stdout))
-        print("Test {} stderr: {}".format(test_name, stderr))
-    exit(0)
-else:
-    print("Test failed: {} - runtime: {} seconds".format(test_name, execution_time / (10 ** 9)))
-    print("Test failed - Dumping Stderr:\n{}\n\nDumping Stdout:\n{}\n".format(stderr, stdout), file=sys.stderr)
-    exit(1)
+def main():
+    args = parser.parse_args()
+    print("Arguments: {}".format(args.runner_args))
+    assert args.timeout > 0, "Timeout must be a positive integer" # Todo: add range checking directly into parser.add_argument
+    assert args.jobs is None or args.jobs > 0, "Jobs must be a positive integer"
+    if args.bootloader_path is not None:
+        _validated_bootloader(args.bootloader_path)
+    # ToDo: Add additional test based arguments for qemu / uhyve
+
+    batch_mode = args.jobs is not None and args.jobs > 1
+    if not batch_mode and len(args.runner_args) > 1 and not args.gdb:
+        # Cargo may pass harness flags in front of the executable, so only switch into batch mode
+        # automatically when every runner argument is an existing file
+        batch_mode = all(os.path.isfile(arg) for arg in args.runner_args)
+    if batch_mode:
+        # Batch mode: every runner argument is treated as a test executable and the tests are run in
+        # parallel. Since each test boots its own VM, the overall wall time approaches the time of the
+        # slowest test instead of the sum of all tests.
+        test_exes = args.runner_args
+        if not args.no_validate:
+            for test_exe in test_exes:
+                assert os.path.isfile(test_exe), "Invalid path to test executable: {}".format(test_exe)
+        assert not args.gdb, "Gdb is not supported when running tests in parallel"
+        # An explicitly supplied --jobs is honored as-is (--jobs 1 runs the batch serially);
+        # otherwise leave two cores to the host. Either way avoid oversubscription when the tests
+        # themselves are multi-core.
+        jobs = args.jobs if args.jobs is not None else max(1, _CPU_COUNT - 2)
+        jobs = min(jobs, max(1, _CPU_COUNT // args.num_cores), len(test_exes))
+        ok_tests = 0
+        failed_tests = []
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = {executor.submit(run_single_test, test_exe, args): test_exe for test_exe in test_exes}
+            for future in as_completed(futures):
+                if future.result():
+                    ok_tests += 1
+                else:
+                    failed_tests.append(futures[future])
+        print("{} of {} tests passed".format(ok_tests, len(test_exes)))
+        if failed_tests:
+            print("Failed tests:\n{}".format('\n'.join(failed_tests)), file=sys.stderr)
+            exit(1)
+        exit(0)
+
+    # The last argument is the executable, all other arguments are ignored for now - ToDo: recheck this
+    test_exe = args.runner_args[-1]
+    assert isinstance(test_exe, str)
+    if not args.no_validate:
+        # This is the only stat of the test executable; the runner constructors no longer check it
+        assert os.path.isfile(test_exe)  # If this fails likely something about runner args changed
+    exit(0 if run_single_test(test_exe, args) else 1)
+
+
+if __name__ == '__main__':
+    main()
 
 # Todo: improve information about the test:
 #       Maybe we could produce a JUnit XML by iteratively generating it for every call of this script